@@ -3,16 +3,29 @@
 雙區介面與大腦植入 (The UI & Brain)
 """
 
+from __future__ import annotations
+
 import streamlit as st
 from google import genai
 from google.genai import types
-from PIL import Image
-import gspread
-import pandas as pd
-from google.oauth2.service_account import Credentials
-from tenacity import retry, stop_after_attempt, wait_fixed
+from tenacity import (
+    Retrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
+from typing import TYPE_CHECKING
+import hashlib
+import io
 import time
+from uuid import uuid4
+
+# 較重的套件（gspread / pandas / PIL / google.oauth2）延遲至實際使用時才 import
+if TYPE_CHECKING:
+    import pandas as pd
+    from PIL import Image
 
 
 # ============================================================
@@ -27,105 +40,380 @@ st.set_page_config(
 
 
 # ============================================================
-# Google Sheets 連線 (Cached)
+# Secrets 讀取 (Cached)
 # ============================================================
-@st.cache_resource
-def get_google_sheet_client():
-    """建立並快取 Google Sheets 連線"""
+@st.cache_data(ttl=10)
+def _secrets() -> tuple:
+    """
+    讀取並快取所有設定值
+    - 回傳 (gemini_api_key, sheet_url, gcp_service_account)
+    - 未設定的項目為 None
+    - 快取 10 秒，修改 secrets.toml 後不需重啟即可生效
+    """
     try:
-        creds_dict = st.secrets["gcp_service_account"]
-        scopes = [
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive"
-        ]
-        creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-        client = gspread.authorize(creds)
-        return client
+        api_key = st.secrets["gemini"]["api_key"]
     except (KeyError, FileNotFoundError):
-        return None
+        api_key = None
 
-
-def get_worksheet():
-    """取得工作表"""
-    client = get_google_sheet_client()
-    if client is None:
-        return None
     try:
         sheet_url = st.secrets["google_sheets"]["sheet_url"]
-        spreadsheet = client.open_by_url(sheet_url)
-        worksheet = spreadsheet.sheet1
-        return worksheet
     except (KeyError, FileNotFoundError):
+        sheet_url = None
+
+    try:
+        creds_dict = dict(st.secrets["gcp_service_account"])
+    except (KeyError, FileNotFoundError):
+        creds_dict = None
+
+    return api_key, sheet_url, creds_dict
+
+
+# ============================================================
+# Gemini 連線 (Cached)
+# ============================================================
+@st.cache_resource
+def get_genai_client(api_key: str) -> genai.Client:
+    """建立並快取 Gemini Client（以 API Key 為快取 key）"""
+    return genai.Client(api_key=api_key)
+
+
+@st.cache_resource(ttl=3600)
+def get_response_cache() -> dict:
+    """
+    建立並快取 Gemini 回應快取（每小時整批清空）
+    - key: (model, system_prompt, content_hash)，value: 回應文字
+    """
+    return {}
+
+
+def get_content_hash(text: str, img_hash: str | None = None) -> str:
+    """計算輸入內容（文字 + 圖片 hash）的 blake2b 摘要，作為回應快取的 key"""
+    digest = hashlib.blake2b(text.encode(), digest_size=16)
+    if img_hash:
+        digest.update(img_hash.encode())
+    return digest.hexdigest()
+
+
+def generate_response(api_key: str, model: str, system_prompt: str, contents: list, content_hash: str) -> str:
+    """
+    呼叫 Gemini 並串流顯示回應
+    - 一小時內相同 (model, system_prompt, content_hash) 直接顯示快取，不重新呼叫 API
+    - 未命中時串流顯示（收到第一段即開始顯示），完成後存入快取
+    """
+    cache = get_response_cache()
+    cache_key = (model, system_prompt, content_hash)
+    placeholder = st.empty()
+
+    if cache_key in cache:
+        placeholder.markdown(cache[cache_key])
+        return cache[cache_key]
+
+    client = get_genai_client(api_key)
+    stream = client.models.generate_content_stream(
+        model=model,
+        contents=contents,
+        config=types.GenerateContentConfig(
+            system_instruction=system_prompt
+        )
+    )
+
+    response_text = ""
+    for chunk in stream:
+        response_text += chunk.text or ""
+        placeholder.markdown(response_text + "▌")
+    placeholder.markdown(response_text)
+
+    if response_text:
+        cache[cache_key] = response_text
+    return response_text
+
+
+# ============================================================
+# Google Sheets 連線 (Cached)
+# ============================================================
+# 工作表欄位（id 用於避免重試時重複寫入）
+LOG_COLUMNS = ["id", "timestamp", "role", "tag", "content"]
+LOG_LAST_COLUMN = chr(ord("A") + len(LOG_COLUMNS) - 1)
+
+
+@st.cache_resource
+def get_google_sheet_client(creds_dict: dict):
+    """建立並快取 Google Sheets 連線（以憑證內容為快取鍵，更換憑證後自動重建）"""
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+    scopes = [
+        "https://www.googleapis.com/auth/spreadsheets",
+        "https://www.googleapis.com/auth/drive"
+    ]
+    creds = Credentials.from_service_account_info(creds_dict, scopes=scopes)
+    client = gspread.authorize(creds)
+    return client
+
+
+@st.cache_resource
+def get_worksheet(sheet_url: str, creds_dict: dict):
+    """
+    取得並快取工作表
+    - 以 sheet_url 與憑證為快取鍵，同一組設定只呼叫一次 open_by_url；修改 secrets.toml 後自動開啟新的工作表
+    - 開啟失敗（網址錯誤、未共用等）直接拋出例外，不會被快取
+    """
+    client = get_google_sheet_client(creds_dict)
+
+    import gspread
+
+    try:
+        spreadsheet = client.open_by_url(sheet_url)
+    except gspread.exceptions.SpreadsheetNotFound as e:
+        raise gspread.exceptions.SpreadsheetNotFound("找不到試算表，請確認 sheet_url 與共用設定") from e
+    worksheet = spreadsheet.sheet1
+    return worksheet
+
+
+def get_current_worksheet():
+    """依目前的 secrets 取得工作表；尚未設定時回傳 None（不快取，設定完成後即可使用）"""
+    _, sheet_url, creds_dict = _secrets()
+    if sheet_url is None or creds_dict is None:
         return None
-    except Exception:
-        return None
+    return get_worksheet(sheet_url, creds_dict)
+
+
+# 加入 id 欄之前的舊版 Header
+LEGACY_LOG_COLUMNS = ["timestamp", "role", "tag", "content"]
+
+
+@st.cache_resource
+def ensure_log_header(spreadsheet_id: str, sheet_id: int, _worksheet) -> bool:
+    """
+    寫入前確認工作表 Header（每張工作表每個 process 只檢查一次）
+    - 空白表：寫入 Header
+    - 舊版 Header：在最前面插入 id 欄
+    - 其他 Header：不修改，拋出 ValueError
+    - 失敗時拋出例外（不會被快取），下次寫入時重新檢查
+    """
+    header = _worksheet.row_values(1)
+    if not header:
+        _worksheet.append_row(LOG_COLUMNS, value_input_option="RAW")
+    elif header == LEGACY_LOG_COLUMNS:
+        _worksheet.insert_cols([["id"]], col=1, value_input_option="RAW")
+    elif header[:len(LOG_COLUMNS)] != LOG_COLUMNS:
+        raise ValueError(f"工作表 Header 不符，應為 {LOG_COLUMNS}，目前為 {header}")
+    return True
 
 
 # ============================================================
 # 強健寫入函式 (with Retry)
 # ============================================================
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
-def add_log(role: str, tag: str, content: str):
+def get_timestamp() -> str:
+    """取得台灣時間 (UTC+8) 時間戳記"""
+    tw_tz = timezone(timedelta(hours=8))
+    return datetime.now(tw_tz).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def get_log_worksheet():
     """
-    寫入對話紀錄至 Google Sheets
-    - 自動重試 3 次，每次間隔 2 秒
-    - 內容超過 50,000 字元自動截斷
+    取得寫入用的工作表（在主執行緒呼叫，背景寫入時不需再碰 Streamlit 快取）
+    - 尚未設定時拋出 RuntimeError
+    - 寫入前確認 Header（見 ensure_log_header）
     """
-    worksheet = get_worksheet()
+    worksheet = get_current_worksheet()
     if worksheet is None:
-        raise Exception("無法連線至 Google Sheets")
+        raise RuntimeError("Google Sheets 尚未設定")
+    ensure_log_header(worksheet.spreadsheet_id, worksheet.id, worksheet)
+    return worksheet
+
+
+def add_log(role: str, tag: str, content: str):
+    """
+    寫入單筆對話紀錄至 Google Sheets
+    - 透過 add_logs() 寫入，沿用其重試與截斷機制
+    """
+    add_logs(get_log_worksheet(), [[get_timestamp(), role, tag, content]])
+
+
+def _is_transient_error(exc: BaseException) -> bool:
+    """
+    只重試暫時性錯誤（API 限流 429 / 伺服器錯誤 5xx、網路中斷）
+    - 權限不足 (403)、找不到試算表等設定錯誤不重試
+    """
+    import gspread
+    import requests
+
+    if isinstance(exc, gspread.exceptions.APIError):
+        # 以 HTTP 狀態碼判斷（前端回傳 HTML 錯誤頁時 exc.code 為 -1）
+        status = exc.response.status_code
+        return status == 429 or status >= 500
+
+    return isinstance(exc, (
+        ConnectionError,
+        TimeoutError,
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+    ))
+
+
+def _rows_already_written(worksheet, rows: list[list[str]]) -> bool:
+    """檢查最近 20 列是否已有這批資料的 id（append_rows 為整批寫入，檢查最後一筆即可）"""
+    recent_ids = worksheet.col_values(1)[-20:]
+    return rows[-1][0] in recent_ids
+
 
+def add_logs(worksheet, rows: list[list[str]]):
+    """
+    批次寫入多筆對話紀錄至 Google Sheets
+    - worksheet 由 get_log_worksheet() 取得；本函式不呼叫 Streamlit，可在背景執行緒執行
+    - 每筆格式為 [timestamp, role, tag, content]，寫入時自動在最前面加上 id
+    - 單次 append_rows 寫入全部資料，減少 HTTP 往返
+    - 暫時性錯誤最多嘗試 4 次，間隔以指數退避加隨機抖動 (上限 10 秒)
+    - 重試前先以 id 檢查上一次是否已寫入，避免重複寫入
+    - 內容超過 50,000 字元自動截斷
+    """
     # 防呆：截斷過長內容
     max_length = 50000
-    if len(content) > max_length:
-        content = content[:max_length] + "...(truncated)"
+    safe_rows = []
+    for timestamp, role, tag, content in rows:
+        if len(content) > max_length:
+            content = content[:max_length] + "...(truncated)"
+        safe_rows.append([uuid4().hex, timestamp, role, tag, content])
+
+    for attempt in Retrying(
+        stop=stop_after_attempt(4),
+        wait=wait_exponential_jitter(initial=1, max=10, jitter=2),
+        retry=retry_if_exception(_is_transient_error),
+        reraise=True,  # 重試用盡時拋出原本的錯誤，而非 RetryError
+    ):
+        with attempt:
+            # 重試時：上一次可能已寫入但回應遺失
+            if attempt.retry_state.attempt_number > 1 and _rows_already_written(worksheet, safe_rows):
+                return
+
+            # 一次寫入至最後一行
+            # RAW：不解析公式；INSERT_ROWS + table_range：直接插入新列，不需掃描表格範圍
+            worksheet.append_rows(
+                safe_rows,
+                value_input_option="RAW",
+                insert_data_option="INSERT_ROWS",
+                table_range="A1",
+            )
 
-    # 準備寫入資料 (使用台灣時間 UTC+8)
-    tw_tz = timezone(timedelta(hours=8))
-    timestamp = datetime.now(tw_tz).strftime("%Y-%m-%d %H:%M:%S")
-    row = [timestamp, role, tag, content]
 
-    # 寫入至最後一行
-    worksheet.append_row(row)
+# ============================================================
+# 背景寫入 (Cached Executor)
+# ============================================================
+@st.cache_resource
+def get_writer() -> ThreadPoolExecutor:
+    """建立並快取背景寫入用的 Thread Pool"""
+    return ThreadPoolExecutor(max_workers=2)
+
+
+def check_pending_writes():
+    """
+    檢查背景寫入的結果
+    - 已完成的寫入以 st.toast 通知成功或失敗，並從待處理清單移除
+    - 寫入成功後清除列數快取，讓紀錄區讀取到新資料
+    """
+    still_pending = []
+    for future in st.session_state.pending_writes:
+        if not future.done():
+            still_pending.append(future)
+        elif future.exception() is not None:
+            st.toast(f"❌ 紀錄寫入失敗: {str(future.exception())}")
+        else:
+            get_log_row_count.clear()
+            st.toast("✅ 紀錄已寫入")
+    st.session_state.pending_writes = still_pending
 
 
 # ============================================================
-# 讀取歷史紀錄 (Cached)
+# 讀取歷史紀錄 (增量快取)
 # ============================================================
 @st.cache_data(ttl=5)
-def get_logs() -> pd.DataFrame:
+def get_log_row_count(spreadsheet_id: str, sheet_id: int, _worksheet) -> int:
+    """
+    取得工作表目前的列數（含 Header）
+    - 以試算表 / 工作表 id 為快取鍵，更換工作表後不會沿用舊的列數
+    - 只讀取第 2 欄，不下載整張表（新版為 timestamp、舊版為 role，每列皆有值；id 欄在舊資料為空，不適合計數）
+    """
+    return len(_worksheet.col_values(2))
+
+
+def get_logs(limit: int = 100) -> pd.DataFrame:
     """
-    讀取 Google Sheets 所有紀錄
-    - 使用 get_all_values() 取代 get_all_records() 避免 Header 問題
+    讀取 Google Sheets 最近 limit 筆紀錄（增量更新）
+    - 已讀取的資料保存在 st.session_state.log_cache_df / log_last_row（log_sheet_key 記錄來源工作表，更換後重新讀取）
+    - 首次只抓取 Header 與最後 limit 列，較舊的紀錄不會被下載
+    - 列數未變時直接回傳快取，增加時只抓取新增的列
     - 依 timestamp 倒序排列（最新在最上面）
     """
-    worksheet = get_worksheet()
-    default_columns = ["timestamp", "role", "tag", "content"]
+    import pandas as pd
 
-    if worksheet is None:
-        return pd.DataFrame(columns=default_columns)
+    empty_df = pd.DataFrame(columns=LOG_COLUMNS)
+    cached_df = st.session_state.get("log_cache_df")
+    last_row = st.session_state.get("log_last_row", 0)
 
     try:
-        # 使用 get_all_values() 取得原始資料
-        all_values = worksheet.get_all_values()
+        worksheet = get_current_worksheet()
+        if worksheet is None:
+            return empty_df
 
-        # 若資料少於 2 列（只有標題或全空），回傳空 DataFrame
-        if len(all_values) < 2:
-            return pd.DataFrame(columns=default_columns)
+        # 工作表已更換：捨棄舊工作表的快取
+        sheet_key = (worksheet.spreadsheet_id, worksheet.id)
+        if st.session_state.get("log_sheet_key") != sheet_key:
+            cached_df = None
+            last_row = 0
 
-        # 第一列為 Header，第二列之後為 Data
-        header = all_values[0]
-        data = all_values[1:]
+        row_count = get_log_row_count(*sheet_key, worksheet)
 
-        df = pd.DataFrame(data, columns=header)
+        # 列數未變：直接回傳快取
+        if cached_df is not None and row_count == last_row:
+            return cached_df
 
-        # 依 timestamp 倒序排列（最新的在最上面）
-        if "timestamp" in df.columns:
-            df = df.sort_values(by="timestamp", ascending=False).reset_index(drop=True)
+        # 首次讀取或紀錄被刪除：重新讀取
+        if cached_df is None or row_count < last_row:
+            cached_df = None
+            last_row = 0
 
+        # 若資料少於 2 列（只有標題或全空），回傳空 DataFrame
+        if row_count < 2:
+            df = empty_df
+        else:
+            # 只抓取最後 limit 列範圍內尚未讀取的列
+            start_row = max(last_row + 1, 2, row_count - limit + 1)
+            data_range = f"A{start_row}:{LOG_LAST_COLUMN}{row_count}"
+
+            # 首次讀取時以同一個 batch_get 一併取得 Header，之後沿用快取的欄位
+            if cached_df is None:
+                header_values, values = worksheet.batch_get([f"A1:{LOG_LAST_COLUMN}1", data_range])
+                header = header_values[0] if header_values else LOG_COLUMNS
+            else:
+                values = worksheet.get(data_range)
+                header = list(cached_df.columns)
+
+                # 新資料欄位多於快取（例如其他寫入已加入 id 欄）：捨棄快取重新讀取
+                if any(len(row) > len(header) for row in values):
+                    st.session_state.log_cache_df = None
+                    return get_logs(limit)
+
+            # 補齊尾端空白欄位
+            data = [row + [""] * (len(header) - len(row)) for row in values]
+            df = pd.DataFrame(data, columns=header)
+
+            # 只排序新增的部分（最新的在最上面），再接上舊資料
+            # 先轉為 datetime 再排序（int64 比較快於字串）；同一秒的紀錄以工作表中較後面的列排在上面
+            if "timestamp" in df.columns:
+                df["_ts"] = pd.to_datetime(df["timestamp"], format="%Y-%m-%d %H:%M:%S", cache=True, errors="coerce")
+                df["_pos"] = range(len(df))
+                df = df.sort_values(["_ts", "_pos"], ascending=False).drop(columns=["_ts", "_pos"])
+            if cached_df is not None and not cached_df.empty:
+                df = pd.concat([df, cached_df])
+            df = df.head(limit).reset_index(drop=True)
+
+        st.session_state.log_cache_df = df
+        st.session_state.log_last_row = row_count
+        st.session_state.log_sheet_key = sheet_key
         return df
     except Exception:
-        return pd.DataFrame(columns=default_columns)
+        return cached_df if cached_df is not None else empty_df
 
 
 # ============================================================
@@ -133,40 +421,50 @@ def get_logs() -> pd.DataFrame:
 # ============================================================
 def check_sheets_connection() -> bool:
     """檢查 Google Sheets 是否已設定"""
-    try:
-        _ = st.secrets["gcp_service_account"]
-        _ = st.secrets["google_sheets"]["sheet_url"]
-        return True
-    except (KeyError, FileNotFoundError):
-        return False
+    _, sheet_url, creds_dict = _secrets()
+    return sheet_url is not None and creds_dict is not None
 
 
 # ============================================================
 # System Instruction 輔助函式
 # ============================================================
+# 圖片處理基礎指令
+_BASE_INSTRUCTION = "若輸入包含圖片,請先用一段括號文字 `[圖片描述：...]` 客觀描述圖片內容,再回答問題。\n\n"
+
+# (mode, depth) → System Prompt
+_SYS_PROMPTS = {
+    ("translate", None): _BASE_INSTRUCTION + "你是一個學術翻譯。將輸入內容翻譯成流暢的繁體中文，精確保留術語，不要做額外解釋。",
+    ("explain", "摘要"): _BASE_INSTRUCTION + "用一句話解釋這個概念的定義。",
+    ("explain", "詳解"): _BASE_INSTRUCTION + "詳細解釋這段內容。如果是概念，說明其原理；如果是論述，分析其邏輯。",
+    ("explain", "延伸"): _BASE_INSTRUCTION + "解釋這段內容，並延伸介紹相關聯的學術概念。",
+}
+
+# 解釋深度 → Tag
+_DEPTH_TAG = {
+    "摘要": "explain_brief",
+    "詳解": "explain_std",
+    "延伸": "explain_deep",
+}
+
+# 筆記類型 → Tag
+_NOTE_TAG = {
+    "問題": "question",
+    "理解": "understand",
+    "洞察": "insight",
+}
+
+# Log Zone 過濾用 Tags
+_AI_TAGS = ["vocab", *_DEPTH_TAG.values()]
+_USER_NOTE_TAGS = list(_NOTE_TAG.values())
+
+
 def get_system_instruction(mode: str, depth: str = None) -> str:
     """
     集中管理 System Prompts
     - mode="translate": 翻譯模式
-    - mode="explain": 解釋模式 (需指定 depth)
+    - mode="explain": 解釋模式 (需指定 depth，未知時使用「詳解」)
     """
-    # 圖片處理基礎指令
-    base_instruction = "若輸入包含圖片,請先用一段括號文字 `[圖片描述：...]` 客觀描述圖片內容,再回答問題。\n\n"
-
-    if mode == "translate":
-        return base_instruction + "你是一個學術翻譯。將輸入內容翻譯成流暢的繁體中文，精確保留術語，不要做額外解釋。"
-
-    elif mode == "explain":
-        if depth == "摘要":
-            return base_instruction + "用一句話解釋這個概念的定義。"
-        elif depth == "詳解":
-            return base_instruction + "詳細解釋這段內容。如果是概念，說明其原理；如果是論述，分析其邏輯。"
-        elif depth == "延伸":
-            return base_instruction + "解釋這段內容，並延伸介紹相關聯的學術概念。"
-        else:
-            return base_instruction + "詳細解釋這段內容。"
-
-    return base_instruction
+    return _SYS_PROMPTS.get((mode, depth), _SYS_PROMPTS[("explain", "詳解")])
 
 
 # ============================================================
@@ -177,15 +475,74 @@ def get_api_key() -> str:
     取得並驗證 Gemini API Key
     若未設定或無效，顯示錯誤訊息並停止執行
     """
-    try:
-        api_key = st.secrets["gemini"]["api_key"]
-        if not api_key or api_key == "YOUR_GEMINI_API_KEY_HERE":
-            st.error("請先設定 Gemini API Key")
-            st.stop()
-        return api_key
-    except (KeyError, FileNotFoundError):
+    api_key, _, _ = _secrets()
+    if api_key is None:
         st.error("找不到 API Key 設定")
         st.stop()
+    if not api_key or api_key == "YOUR_GEMINI_API_KEY_HERE":
+        st.error("請先設定 Gemini API Key")
+        st.stop()
+    return api_key
+
+
+# ============================================================
+# 圖片處理 (Cached in Session)
+# ============================================================
+MAX_IMAGE_EDGE = 1536
+
+
+def load_uploaded_image(uploaded_file) -> tuple[Image.Image, types.Part]:
+    """
+    解碼上傳的圖片並存入 session_state
+    - 以檔案 MD5 判斷是否為同一張圖片，同一張只解碼、縮圖、編碼一次
+    - 依 EXIF Orientation 轉正（手機直拍照片），預覽與送出皆使用轉正後的圖片
+    - 長邊縮小至 1536px；無透明度的圖片以 JPEG (quality 85) 編碼以減少上傳量
+    - 回傳 (預覽用 PIL 物件, 送出用的 Part)；Part 直接帶編碼後的 bytes，
+      避免 SDK 將 PIL 物件重新編碼為 PNG
+    """
+    img_bytes = uploaded_file.getvalue()
+    file_hash = hashlib.md5(img_bytes).hexdigest()
+
+    if st.session_state.get("img_hash") != file_hash:
+        from PIL import Image, ImageOps
+
+        image = Image.open(io.BytesIO(img_bytes))
+        source_format = image.format
+        source_size = image.size
+
+        # 依 EXIF 轉正（重新編碼會捨棄 EXIF，須在縮圖前先套用）
+        rotated = image.getexif().get(0x0112, 1) != 1  # 0x0112: Orientation
+        image = ImageOps.exif_transpose(image)
+
+        # 縮圖（thumbnail 只會縮小、保持比例）
+        image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.Resampling.LANCZOS)
+        resized = rotated or image.size != source_size  # 轉正過的圖片也不能沿用原檔
+
+        # 編碼送出用的 bytes：
+        # - 未縮圖、未轉正的 JPEG 直接沿用原檔，不重新壓縮
+        # - 有透明度的圖片使用 PNG
+        # - 其他一律轉為 JPEG
+        has_alpha = "A" in image.getbands() or "transparency" in image.info
+        if source_format == "JPEG" and not resized:
+            upload_bytes, mime_type = img_bytes, "image/jpeg"
+        elif has_alpha:
+            if source_format == "PNG" and not resized:
+                upload_bytes = img_bytes
+            else:
+                buf = io.BytesIO()
+                image.save(buf, "PNG")
+                upload_bytes = buf.getvalue()
+            mime_type = "image/png"
+        else:
+            buf = io.BytesIO()
+            image.convert("RGB").save(buf, "JPEG", quality=85)
+            upload_bytes, mime_type = buf.getvalue(), "image/jpeg"
+
+        st.session_state.img_hash = file_hash
+        st.session_state.img_pil = image
+        st.session_state.img_part = types.Part.from_bytes(data=upload_bytes, mime_type=mime_type)
+
+    return st.session_state.img_pil, st.session_state.img_part
 
 
 # ============================================================
@@ -193,15 +550,23 @@ def get_api_key() -> str:
 # ============================================================
 if "input_ai" not in st.session_state:
     st.session_state.input_ai = ""
+if "submitted_ai" not in st.session_state:
+    st.session_state.submitted_ai = ""  # 按下翻譯/解釋時送出的內容
 if "input_user" not in st.session_state:
     st.session_state.input_user = ""
 
 # 清空輸入框的 flag
-if "clear_input_ai" not in st.session_state:
-    st.session_state.clear_input_ai = False
 if "clear_input_user" not in st.session_state:
     st.session_state.clear_input_user = False
 
+# 背景寫入中的 Future
+if "pending_writes" not in st.session_state:
+    st.session_state.pending_writes = []
+
+# 是否已載入歷史紀錄（點擊後才讀取 Sheets）
+if "load_logs" not in st.session_state:
+    st.session_state.load_logs = False
+
 
 # ============================================================
 # 標題
@@ -237,76 +602,103 @@ with st.expander("⚙️ 系統設定", expanded=False):
 # ============================================================
 # 上方顯示區 (Log Zone) - 雙 Tab 分頁
 # ============================================================
+# 完整格式顯示的最近紀錄筆數，其餘以表格顯示
+RICH_LOG_LIMIT = 20
+
 st.subheader("📜 學習紀錄")
 st.caption("💡 最新紀錄在最上方")
 
-with st.container(height=400):
-    if sheets_connected:
-        try:
-            logs_df = get_logs()
-            if logs_df.empty:
-                st.info("目前沒有歷史紀錄，開始你的學習之旅吧！")
-            else:
-                # Log Zone 雙 Tab
-                log_tab_ai, log_tab_user = st.tabs(["🤖 AI 歷程", "📝 思考足跡"])
-
-                # AI 相關 Tags
-                ai_tags = ["vocab", "explain_brief", "explain_std", "explain_deep"]
-
-                # User 筆記 Tags
-                user_note_tags = ["question", "understand", "insight"]
-
-                with log_tab_ai:
-                    # 過濾: role == "ai" OR tag in vocab/explain 系列
-                    ai_logs = logs_df[
-                        (logs_df["role"] == "ai") |
-                        (logs_df["tag"].isin(ai_tags))
-                    ]
-
-                    if ai_logs.empty:
-                        st.info("💡 還沒有 AI 對話紀錄，試試下方的「翻譯」或「解釋」功能吧！")
-                    else:
-                        for _, row in ai_logs.iterrows():
-                            role = row.get("role", "")
-                            tag = row.get("tag", "")
-                            content = row.get("content", "")
-                            timestamp = row.get("timestamp", "")
-
-                            if role == "ai":
-                                # AI 回應使用 blockquote（處理多行內容的換行）
-                                content_lines = content.split('\n')
-                                formatted_content = '  \n> '.join(content_lines)
-                                st.markdown(f"> **🤖 [{tag}]**  \n> {formatted_content}")
-                                st.caption(f"🕐 {timestamp}")
-                            else:
-                                # User 提問
-                                st.markdown(f"**[{tag}]** {content}")
+
+@st.fragment(run_every=5)
+def render_logs(sheets_connected: bool):
+    """
+    顯示學習紀錄（獨立 fragment）
+    - 每 5 秒自動重新執行，輸入區的操作不會觸發重新讀取紀錄
+    - 使用者點擊「載入紀錄」前不讀取 Sheets
+    """
+    # 先處理已完成的背景寫入，再讀取紀錄
+    check_pending_writes()
+
+    with st.container(height=400):
+        if sheets_connected and not st.session_state.load_logs:
+            # 尚未載入：不讀取 Sheets，等使用者點擊後才載入
+            st.info("點擊下方按鈕載入歷史紀錄")
+            st.button("📥 載入紀錄", on_click=lambda: st.session_state.update(load_logs=True))
+        elif sheets_connected:
+            try:
+                logs_df = get_logs()
+                if logs_df.empty:
+                    st.info("目前沒有歷史紀錄，開始你的學習之旅吧！")
+                else:
+                    # Log Zone 雙 Tab
+                    log_tab_ai, log_tab_user = st.tabs(["🤖 AI 歷程", "📝 思考足跡"])
+
+                    with log_tab_ai:
+                        # 過濾: role == "ai" OR tag in vocab/explain 系列
+                        ai_logs = logs_df[
+                            (logs_df["role"] == "ai") |
+                            (logs_df["tag"].isin(_AI_TAGS))
+                        ]
+
+                        if ai_logs.empty:
+                            st.info("💡 還沒有 AI 對話紀錄，試試下方的「翻譯」或「解釋」功能吧！")
+                        else:
+                            # 最近的紀錄以完整格式顯示
+                            for row in ai_logs.head(RICH_LOG_LIMIT).itertuples(index=False):
+                                role = getattr(row, "role", "")
+                                tag = getattr(row, "tag", "")
+                                content = getattr(row, "content", "")
+                                timestamp = getattr(row, "timestamp", "")
+
+                                if role == "ai":
+                                    # AI 回應使用 blockquote（處理多行內容的換行）
+                                    content_lines = content.split('\n')
+                                    formatted_content = '  \n> '.join(content_lines)
+                                    st.markdown(f"> **🤖 [{tag}]**  \n> {formatted_content}")
+                                    st.caption(f"🕐 {timestamp}")
+                                else:
+                                    # User 提問
+                                    st.markdown(f"**[{tag}]** {content}")
+                                    st.caption(f"🕐 {timestamp}")
+                                st.divider()
+
+                            # 較早的紀錄改用表格一次顯示
+                            if len(ai_logs) > RICH_LOG_LIMIT:
+                                with st.expander(f"📂 更早的紀錄 ({len(ai_logs) - RICH_LOG_LIMIT} 筆)"):
+                                    st.dataframe(ai_logs.iloc[RICH_LOG_LIMIT:], hide_index=True, use_container_width=True, column_config={"id": None})
+
+                    with log_tab_user:
+                        # 過濾: role == "user" AND tag in question/understand/insight
+                        user_logs = logs_df[
+                            (logs_df["role"] == "user") &
+                            (logs_df["tag"].isin(_USER_NOTE_TAGS))
+                        ]
+
+                        if user_logs.empty:
+                            st.info("💡 還沒有思考筆記，試試在「我的筆記」Tab 記錄你的想法吧！")
+                        else:
+                            # 最近的紀錄以完整格式顯示
+                            for row in user_logs.head(RICH_LOG_LIMIT).itertuples(index=False):
+                                tag = getattr(row, "tag", "")
+                                content = getattr(row, "content", "")
+                                timestamp = getattr(row, "timestamp", "")
+
+                                # 使用 bullet points
+                                st.markdown(f"- **[{tag}]** {content}")
                                 st.caption(f"🕐 {timestamp}")
-                            st.divider()
-
-                with log_tab_user:
-                    # 過濾: role == "user" AND tag in question/understand/insight
-                    user_logs = logs_df[
-                        (logs_df["role"] == "user") &
-                        (logs_df["tag"].isin(user_note_tags))
-                    ]
-
-                    if user_logs.empty:
-                        st.info("💡 還沒有思考筆記，試試在「我的筆記」Tab 記錄你的想法吧！")
-                    else:
-                        for _, row in user_logs.iterrows():
-                            tag = row.get("tag", "")
-                            content = row.get("content", "")
-                            timestamp = row.get("timestamp", "")
-
-                            # 使用 bullet points
-                            st.markdown(f"- **[{tag}]** {content}")
-                            st.caption(f"🕐 {timestamp}")
-
-        except Exception as e:
-            st.error(f"讀取歷史紀錄失敗: {str(e)}")
-    else:
-        st.warning("Google Sheets 尚未設定。請在 .streamlit/secrets.toml 中設定 [gcp_service_account] 和 [google_sheets] sheet_url")
+
+                            # 較早的紀錄改用表格一次顯示
+                            if len(user_logs) > RICH_LOG_LIMIT:
+                                with st.expander(f"📂 更早的紀錄 ({len(user_logs) - RICH_LOG_LIMIT} 筆)"):
+                                    st.dataframe(user_logs.iloc[RICH_LOG_LIMIT:], hide_index=True, use_container_width=True, column_config={"id": None})
+
+            except Exception as e:
+                st.error(f"讀取歷史紀錄失敗: {str(e)}")
+        else:
+            st.warning("Google Sheets 尚未設定。請在 .streamlit/secrets.toml 中設定 [gcp_service_account] 和 [google_sheets] sheet_url")
+
+
+render_logs(sheets_connected)
 
 
 # ============================================================
@@ -320,14 +712,17 @@ tab_ai, tab_note = st.tabs(["🤖 AI 助手", "📝 我的筆記"])
 # ============================================================
 # Tab 1: AI 助手
 # ============================================================
-with tab_ai:
-    # 檢查是否需要清空輸入框
-    if st.session_state.clear_input_ai:
-        st.session_state.input_ai = ""
-        st.session_state.clear_input_ai = False
+def submit_ai_input():
+    """翻譯/解釋按鈕的 on_click：取出輸入框內容供本次處理，並清空輸入框"""
+    st.session_state.submitted_ai = st.session_state.input_ai
+    st.session_state.input_ai = ""
+
 
+@st.fragment
+def render_ai_tab(selected_model: str, sheets_connected: bool):
+    """AI 助手 Tab（獨立 fragment，操作時只重新執行此 Tab）"""
     # 輸入區
-    ai_input = st.text_area(
+    st.text_area(
         "輸入要處理的內容",
         key="input_ai",
         height=120,
@@ -342,9 +737,14 @@ with tab_ai:
         key="img_upload"
     )
 
-    # 顯示上傳的圖片預覽
+    # 顯示上傳的圖片預覽（st.image 不處理 EXIF，使用已轉正的 PIL 物件；編碼後的 Part 供送出時重複使用）
+    image_part = None
     if uploaded_image is not None:
-        st.image(uploaded_image, caption="已上傳的圖片", width=300)
+        try:
+            image, image_part = load_uploaded_image(uploaded_image)
+            st.image(image, caption="已上傳的圖片", width=300)
+        except Exception:
+            st.error("無法讀取圖片，請確認檔案是否為有效的 PNG / JPG / WEBP")
 
     # 深度選擇
     depth_mode = st.pills(
@@ -358,15 +758,20 @@ with tab_ai:
     col1, col2 = st.columns(2)
 
     with col1:
-        btn_translate = st.button("🔤 翻譯", use_container_width=True)
+        btn_translate = st.button("🔤 翻譯", use_container_width=True, on_click=submit_ai_input)
 
     with col2:
-        btn_explain = st.button("🧑‍🏫 解釋", use_container_width=True)
+        btn_explain = st.button("🧑‍🏫 解釋", use_container_width=True, on_click=submit_ai_input)
+
+    # 本次送出的內容（輸入框已在 on_click 中清空）
+    ai_input = st.session_state.submitted_ai
 
     # 翻譯邏輯
     if btn_translate:
         if not ai_input.strip() and uploaded_image is None:
             st.warning("請輸入要翻譯的內容或上傳圖片")
+        elif uploaded_image is not None and image_part is None:
+            st.error("翻譯失敗: 圖片無法讀取，請重新上傳")
         elif not sheets_connected:
             st.error("請先設定 Google Sheets 連線")
         else:
@@ -377,16 +782,18 @@ with tab_ai:
                     # 準備 Log 內容
                     log_content = ai_input.strip() if ai_input.strip() else "(圖片輸入)"
 
-                    # 寫入 User Log
-                    add_log("user", "vocab", log_content)
+                    # 先取得寫入用工作表（設定錯誤時在呼叫 API 前就失敗）
+                    worksheet = get_log_worksheet()
+
+                    # 記錄提問時間（與 AI 回應一併寫入）
+                    user_timestamp = get_timestamp()
 
                     # 準備 API 內容
                     contents = []
 
                     # 處理圖片（如果有）
-                    if uploaded_image is not None:
-                        image = Image.open(uploaded_image)
-                        contents.append(image)
+                    if image_part is not None:
+                        contents.append(image_part)
 
                     # 加入文字
                     if ai_input.strip():
@@ -394,24 +801,21 @@ with tab_ai:
                     elif uploaded_image is not None:
                         contents.append("請翻譯圖片中的文字內容。")
 
-                    # 呼叫 API
-                    client = genai.Client(api_key=api_key)
+                    # 呼叫 API（相同輸入一小時內直接使用快取）
                     system_prompt = get_system_instruction("translate")
-
-                    response = client.models.generate_content(
-                        model=selected_model,
-                        contents=contents,
-                        config=types.GenerateContentConfig(
-                            system_instruction=system_prompt
-                        )
+                    img_hash = st.session_state.img_hash if image_part is not None else None
+                    content_hash = get_content_hash(contents[-1], img_hash)
+                    response_text = generate_response(
+                        api_key, selected_model, system_prompt, contents, content_hash
                     )
 
-                    # 寫入 AI Log
-                    add_log("ai", "vocab", response.text)
-                    st.session_state.clear_input_ai = True  # 設定清空 flag
+                    # 背景一次寫入 User + AI Log，不阻塞回應顯示
+                    future = get_writer().submit(add_logs, worksheet, [
+                        [user_timestamp, "user", "vocab", log_content],
+                        [get_timestamp(), "ai", "vocab", response_text],
+                    ])
+                    st.session_state.pending_writes.append(future)
                     st.toast("✅ 翻譯完成！")
-                    time.sleep(0.5)
-                    st.rerun()
 
                 except Exception as e:
                     st.error(f"翻譯失敗: {str(e)}")
@@ -420,34 +824,33 @@ with tab_ai:
     if btn_explain:
         if not ai_input.strip() and uploaded_image is None:
             st.warning("請輸入要解釋的內容或上傳圖片")
+        elif uploaded_image is not None and image_part is None:
+            st.error("解釋失敗: 圖片無法讀取，請重新上傳")
         elif not sheets_connected:
             st.error("請先設定 Google Sheets 連線")
         else:
             api_key = get_api_key()
 
             # 根據深度決定 Tag
-            depth_tag_map = {
-                "摘要": "explain_brief",
-                "詳解": "explain_std",
-                "延伸": "explain_deep"
-            }
-            tag = depth_tag_map.get(depth_mode, "explain_std")
+            tag = _DEPTH_TAG.get(depth_mode, "explain_std")
 
             with st.spinner("解釋中..."):
                 try:
                     # 準備 Log 內容
                     log_content = ai_input.strip() if ai_input.strip() else "(圖片輸入)"
 
-                    # 寫入 User Log
-                    add_log("user", tag, log_content)
+                    # 先取得寫入用工作表（設定錯誤時在呼叫 API 前就失敗）
+                    worksheet = get_log_worksheet()
+
+                    # 記錄提問時間（與 AI 回應一併寫入）
+                    user_timestamp = get_timestamp()
 
                     # 準備 API 內容
                     contents = []
 
                     # 處理圖片（如果有）
-                    if uploaded_image is not None:
-                        image = Image.open(uploaded_image)
-                        contents.append(image)
+                    if image_part is not None:
+                        contents.append(image_part)
 
                     # 加入文字
                     if ai_input.strip():
@@ -455,33 +858,36 @@ with tab_ai:
                     elif uploaded_image is not None:
                         contents.append("請解釋圖片中的內容。")
 
-                    # 呼叫 API
-                    client = genai.Client(api_key=api_key)
+                    # 呼叫 API（相同輸入一小時內直接使用快取）
                     system_prompt = get_system_instruction("explain", depth_mode)
-
-                    response = client.models.generate_content(
-                        model=selected_model,
-                        contents=contents,
-                        config=types.GenerateContentConfig(
-                            system_instruction=system_prompt
-                        )
+                    img_hash = st.session_state.img_hash if image_part is not None else None
+                    content_hash = get_content_hash(contents[-1], img_hash)
+                    response_text = generate_response(
+                        api_key, selected_model, system_prompt, contents, content_hash
                     )
 
-                    # 寫入 AI Log
-                    add_log("ai", tag, response.text)
-                    st.session_state.clear_input_ai = True  # 設定清空 flag
+                    # 背景一次寫入 User + AI Log，不阻塞回應顯示
+                    future = get_writer().submit(add_logs, worksheet, [
+                        [user_timestamp, "user", tag, log_content],
+                        [get_timestamp(), "ai", tag, response_text],
+                    ])
+                    st.session_state.pending_writes.append(future)
                     st.toast("✅ 解釋完成！")
-                    time.sleep(0.5)
-                    st.rerun()
 
                 except Exception as e:
                     st.error(f"解釋失敗: {str(e)}")
 
 
+with tab_ai:
+    render_ai_tab(selected_model, sheets_connected)
+
+
 # ============================================================
 # Tab 2: 我的筆記
 # ============================================================
-with tab_note:
+@st.fragment
+def render_note_tab(sheets_connected: bool):
+    """我的筆記 Tab（獨立 fragment，操作時只重新執行此 Tab）"""
     # 檢查是否需要清空輸入框
     if st.session_state.clear_input_user:
         st.session_state.input_user = ""
@@ -513,19 +919,19 @@ with tab_note:
             st.error("請先設定 Google Sheets 連線")
         else:
             # 根據意圖決定 Tag
-            note_tag_map = {
-                "問題": "question",
-                "理解": "understand",
-                "洞察": "insight"
-            }
-            tag = note_tag_map.get(note_tag, "understand")
+            tag = _NOTE_TAG.get(note_tag, "understand")
 
             with st.spinner("儲存中..."):
                 try:
                     add_log("user", tag, note_input.strip())
+                    get_log_row_count.clear()  # 讓紀錄區重新執行時讀取到新筆記
                     st.session_state.clear_input_user = True  # 設定清空 flag
                     st.toast("✅ 筆記已儲存！")
                     time.sleep(0.5)
                     st.rerun()
                 except Exception as e:
                     st.error(f"儲存失敗: {str(e)}")
+
+
+with tab_note:
+    render_note_tab(sheets_connected)